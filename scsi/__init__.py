@@ -11,23 +11,60 @@ the roadmap for this module, but it could be done if there is demand.
 The API provided by this module is given by a small set of functions:
     - scsi_open: Open a device file and return a file descriptor.
     - scsi_read: Send a command, then read and return the response.
+    - scsi_read_into: Send a command, then read into a given buffer.
+    - scsi_read_batch: Send several commands and read all responses.
     - scsi_write: Send a command alongside additional data.
+    - scsi_write_from: Send a command alongside data from a buffer.
+    - scsi_alloc_buffer: Allocate an aligned buffer, locked in memory.
     - scsi_close: Close a device with a given file descriptor.
-"""
 
-import platform
+Each response from `scsi_read` and `scsi_read_batch` is exactly as
+long as the amount that was asked for. If the device sends back less
+than that, the rest of the response is filled in with zeroes.
+
+The `_into` and `_from` variants accept any C-contiguous object that
+supports the buffer protocol (such as `bytearray`, `memoryview` or
+`mmap`), and hand its memory to the device without copying it. Note
+that aligning these buffers is left to the caller, so they must be
+page-aligned if the device is expected to transfer directly to them.
+Buffers from `scsi_alloc_buffer` are ready to be reused in this way.
+Much like `readinto` on a file, `scsi_read_into` returns the number of
+bytes the device actually sent, leaving the rest of the buffer as is.
+
+Some platforms also provide extra functions beyond the ones above. On
+Windows, `scsi_submit` queues a command up without waiting for it, and
+`scsi_reap` waits for a number of submitted commands to complete. It
+returns a `ReapedCommand` for each one, holding its token, how many
+bytes it transferred, and the error it failed with (if any). On
+Linux, `scsi_set_reserved_size` changes the size of the SG driver's
+reserved buffer. Opening a device with `direct_io=True` asks the SG
+driver to transfer straight to page-aligned buffers, provided that
+direct I/O has been enabled through /proc/scsi/sg/allow_dio. On such
+a device, transfers from buffers which are not page-aligned, and are
+smaller than the reserved buffer, are bounced through an aligned
+buffer of our own.
+"""
 
-os_info = platform.uname()
+import sys
 
-if os_info.system == "Linux":
+if sys.platform == "linux":
     from scsi._scsi_linux import *
 
 # this module has not yet been tested for anything below windows 10.
 # until it is confirmed to work, i am restricting the version here.
-elif os_info.system == "Windows" and os_info.release == "10":
+elif sys.platform == "win32" and sys.getwindowsversion().major >= 10:
     from scsi._scsi_windows import *
 
 else:
     raise NotImplementedError("Your system is not supported.")
 
-__all__ = ["scsi_open", "scsi_read", "scsi_write", "scsi_close"]
+__all__ = [
+    "scsi_open",
+    "scsi_read",
+    "scsi_read_into",
+    "scsi_read_batch",
+    "scsi_write",
+    "scsi_write_from",
+    "scsi_alloc_buffer",
+    "scsi_close",
+]
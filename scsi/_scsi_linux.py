@@ -1,17 +1,47 @@
 import ctypes as ct
+import itertools
+import mmap
 import os
+import select
+import struct
+import threading
+import warnings
 from enum import IntEnum
 from fcntl import ioctl
-from typing import Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
 
 from scsi.utils import (
     MAX_SENSE_SIZE,
+    PAGE_SIZE,
+    Buffer,
+    BufferPool,
     SCSIError,
     SCSIStatus,
+    StructurePool,
     TypedStructure,
+    buffer_address,
+    map_aligned,
+    read_response,
+    zero_filled,
 )
 
-__all__ = ["scsi_open", "scsi_read", "scsi_write", "scsi_close"]
+# the compiled fast path is optional, since it has to be built first.
+try:
+    from scsi._scsi_fast import execute_sync as _execute_sync
+except ImportError:
+    _execute_sync = None
+
+__all__ = [
+    "scsi_open",
+    "scsi_read",
+    "scsi_read_into",
+    "scsi_read_batch",
+    "scsi_write",
+    "scsi_write_from",
+    "scsi_alloc_buffer",
+    "scsi_set_reserved_size",
+    "scsi_close",
+]
 
 # Any global constants and structs from here on out are as defined in
 # the <linux/scsi/sg.h> header, unless otherwise specified.
@@ -21,6 +51,8 @@ SG_DXFER_NONE = -1
 SG_DXFER_TO_DEV = -2
 SG_DXFER_FROM_DEV = -3
 
+SG_SET_RESERVED_SIZE = 0x2275
+SG_GET_RESERVED_SIZE = 0x2272
 SG_GET_VERSION_NUM = 0x2282
 SG_IO = 0x2285
 
@@ -28,6 +60,61 @@ SG_INFO_OK_MASK = 0x1
 SG_INFO_OK = 0x0
 SG_INFO_CHECK = 0x1
 
+SG_FLAG_DIRECT_IO = 0x1
+
+SG_INFO_DIRECT_IO_MASK = 0x6
+SG_INFO_INDIRECT_IO = 0x0
+SG_INFO_DIRECT_IO = 0x2
+
+# this is not in the header, but it's where the SG driver lets the admin
+# decide whether direct I/O is allowed at all. it's off by default.
+SG_ALLOW_DIO_PATH = "/proc/scsi/sg/allow_dio"
+
+# the most commands that the SG driver will queue up for a single file
+# descriptor when they are submitted asynchronously through `write()`.
+SG_MAX_QUEUE = 16
+
+_buffer_pool = BufferPool()
+
+# this is only defined in the `mmap` module from python 3.10 onwards.
+MAP_POPULATE = getattr(mmap, "MAP_POPULATE", 0x8000)
+
+_libc = ct.CDLL(None, use_errno=True)
+_libc.mlock.restype = ct.c_int
+_libc.mlock.argtypes = [ct.c_void_p, ct.c_size_t]
+
+# maps the (st_dev, st_rdev) of each device we've opened to its version.
+_sg_version_cache: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
+
+# each device opened with `direct_io` gets a pinned buffer matching the
+# size of the SG driver's own reserved buffer, which badly aligned
+# transfers that fit inside of it are bounced through, so that they can
+# still be done directly. the lock stops threads from sharing it.
+_reserved_buffers: Dict[int, Tuple[memoryview, threading.Lock]] = {}
+
+# the devices that were opened with `direct_io`, which ask the SG driver
+# to transfer straight to our own buffers instead of through its own.
+_direct_io_devices: Set[int] = set()
+
+# the reads that have been queued up on each device with `write()`, but
+# which have not been read back yet, by their pack_id. these are kept
+# here rather than by whoever queued them, since the kernel still writes
+# into their buffers, and so they must never be freed before they're read.
+_queued_reads: Dict[int, Dict[int, Tuple[memoryview, "SGIORequest"]]] = {}
+
+# every queued read gets a new pack_id, so a reply that was left behind by
+# an earlier batch can never be mistaken for one of the current batch.
+_pack_ids: Dict[int, Iterator[int]] = {}
+
+# replies are read back in whatever order the commands finish, so only a
+# single batch can be in progress on each device at any one time. without
+# this, one batch could end up reading (and throwing away) the replies to
+# the commands of another one, which would then wait for them forever.
+_batch_locks: Dict[int, threading.Lock] = {}
+
+# pack_id is a signed int, so the ids wrap around before overflowing it.
+PACK_ID_MASK = 0x7fffffff
+
 
 class SGIOHeader(TypedStructure):
     interface_id: ct.c_int
@@ -36,9 +123,9 @@ class SGIOHeader(TypedStructure):
     mx_sb_len: ct.c_ubyte
     iovec_count: ct.c_ushort
     dxfer_len: ct.c_uint
-    dxferp: ct.c_char_p
+    dxferp: ct.c_void_p
     cmdp: ct.c_char_p
-    sbp: ct.c_char_p
+    sbp: ct.c_void_p
     timeout: ct.c_uint
     flags: ct.c_uint
     pack_id: ct.c_int
@@ -54,6 +141,57 @@ class SGIOHeader(TypedStructure):
     info: ct.c_uint
 
 
+# the size of `struct sg_io_hdr`, which is laid out naturally rather
+# than packed. if ctypes disagrees, the kernel would read and write the
+# fields in the wrong places, so we'd rather not go any further.
+EXPECTED_SGIO_HEADER_SIZE = 88 if ct.sizeof(ct.c_void_p) == 8 else 64
+
+if ct.sizeof(SGIOHeader) != EXPECTED_SGIO_HEADER_SIZE:
+    raise NotImplementedError(
+        f"Unexpected sg_io_hdr size: {ct.sizeof(SGIOHeader)} bytes"
+    )
+
+
+# this isn't a kernel struct, it just keeps a header together with the
+# sense buffer it points to, so that both can be pooled and reused.
+class SGIORequest(TypedStructure):
+    header: SGIOHeader
+    sense_buffer: ct.c_ubyte * MAX_SENSE_SIZE
+
+
+_request_pool = StructurePool(SGIORequest, SG_MAX_QUEUE)
+
+# the whole header, field for field, so that it can be read back with a
+# single unpack instead of going through ctypes once for every field. the
+# trailing "0P" pads it out to a pointer, just like the C struct itself.
+_SGIO_HEADER = struct.Struct("@iiBBHIPPPIIiPBBBBHHiII0P")
+
+if _SGIO_HEADER.size != ct.sizeof(SGIOHeader):
+    raise NotImplementedError(
+        f"Unexpected sg_io_hdr format size: {_SGIO_HEADER.size} bytes"
+    )
+
+# the unpacked fields come out in the same order as they are declared.
+_SGIO_INDEX = {name: i for i, (name, _) in enumerate(SGIOHeader._fields_)}
+
+_PACK_ID_INDEX = _SGIO_INDEX["pack_id"]
+_DXFER_LEN_INDEX = _SGIO_INDEX["dxfer_len"]
+_RESID_INDEX = _SGIO_INDEX["resid"]
+_INFO_INDEX = _SGIO_INDEX["info"]
+
+# the fields the kernel reads from the header, from `interface_id` up to
+# `usr_ptr`, are also next to each other. every command fills all of them
+# in with one pack, instead of setting the ones that change through ctypes.
+_SGIO_INPUT = struct.Struct("@iiBBHIPPPIIiP")
+
+if _SGIO_INPUT.size != SGIOHeader._field_offsets_["status"]:
+    raise NotImplementedError(
+        f"Unexpected sg_io_hdr input size: {_SGIO_INPUT.size} bytes"
+    )
+
+_SENSE_OFFSET = SGIORequest._field_offsets_["sense_buffer"]
+
+
 class BaseStatus(IntEnum):
     def raise_if_bad(self, message: Optional[str] = None):
         if int(self) != self._GOOD_VALUE:
@@ -124,64 +262,291 @@ def _check_sg_version(device: int) -> Tuple[int, int, int]:
     return ver_major, ver_minor, ver_micro
 
 
-def _check_for_errors(sgio_hdr: SGIOHeader, sense_buffer: bytes):
-    if (sgio_hdr.info & SG_INFO_OK_MASK) != SG_INFO_OK:
-        status = SCSIStatus(sgio_hdr.status)
+def _raise_for_status(
+    status: int,
+    host_status: int,
+    driver_status: int,
+    sense: bytes,
+):
+    # looking up enum members is far from free, so each of these is only
+    # done once we know that the raw value is not the good one.
+    if status != SCSIStatus.GOOD:
+        sense_info = f"sense buffer: {sense.hex()}"
+        SCSIStatus(status).raise_if_bad(sense_info, sense)
+
+    # the 0x0f mask on the driver status code makes sure we only
+    # get the status code itself, and not the suggestion.
+    driver_status &= 0x0f
+
+    if driver_status != DriverStatus.OK:
+        DriverStatus(driver_status).raise_if_bad()
+
+    if host_status != HostStatus.OK:
+        HostStatus(host_status).raise_if_bad()
+
+    # i think all of our bases are covered at this point, but we
+    # should make sure we don't continue silently from this state.
+    # TODO: perhaps this error message can be made more useful by
+    # providing a full dump of the SGIOHeader in some format?
+    raise SCSIError("An unknown error occurred.")
+
+
+def _check_for_errors(header_fields: Tuple[int, ...], request: SGIORequest):
+    (
+        *_,  # everything from `interface_id` through to `usr_ptr`
+        status,
+        _,  # masked_status
+        _,  # msg_status
+        sb_len_wr,
+        host_status,
+        driver_status,
+        _,  # resid
+        _,  # duration
+        info,
+    ) = header_fields
+
+    # almost every command succeeds, so that case gets out of the way
+    # before there's any chance of an enum being constructed.
+    if (info & SG_INFO_OK_MASK) == SG_INFO_OK:
+        return
+
+    # the driver tells us how much sense data it wrote, so whatever was
+    # left in the buffer by earlier commands is never looked at here.
+    _raise_for_status(
+        status,
+        host_status,
+        driver_status,
+        bytes(request.sense_buffer)[:sb_len_wr],
+    )
 
-        buffer = ct.string_at(sgio_hdr.sbp, size=sgio_hdr.sb_len_wr)
-        sense_info = f"sense buffer: {buffer.hex()}"
 
-        status.raise_if_bad(sense_info)
+def _pack_header(
+    request: SGIORequest,
+    cdb_address: int,
+    cdb_length: int,
+    direction: int,
+    address: int,
+    length: int,
+    timeout: int,
+    flags: int,
+    pack_id: int = 0,
+):
+    # the sense buffer is part of the request, so it never moves.
+    sense_address = ct.addressof(request) + _SENSE_OFFSET
+
+    _SGIO_INPUT.pack_into(
+        request,
+        0,
+        SG_INTERFACE_ID_ORIG,
+        direction,
+        cdb_length,
+        MAX_SENSE_SIZE,
+        0,  # iovec_count
+        length,
+        address,
+        cdb_address,
+        sense_address,
+        timeout,
+        flags,
+        pack_id,
+        0,  # usr_ptr
+    )
 
-        # the 0x0f mask on the driver status code makes sure we only
-        # get the status code itself, and not the suggestion.
-        DriverStatus(sgio_hdr.driver_status & 0x0f).raise_if_bad()
-        HostStatus(sgio_hdr.host_status).raise_if_bad()
 
-        # i think all of our bases are covered at this point, but we
-        # should make sure we don't continue silently from this state.
-        # TODO: perhaps this error message can be made more useful by
-        # providing a full dump of the SGIOHeader in some format?
-        raise SCSIError("An unknown error occurred.")
+def _transferred(length: int, resid: int) -> int:
+    # some low level drivers are known to report a residual count that
+    # doesn't make sense, so it's kept within the size of the transfer.
+    return min(max(length - resid, 0), length)
+
+
+def _direct_io_flags(device: int, address: int) -> int:
+    # the driver can only map a buffer for direct I/O if it starts on a
+    # page boundary, so anything else is left to go through the kernel.
+    if device in _direct_io_devices and not address % PAGE_SIZE:
+        return SG_FLAG_DIRECT_IO
+
+    return 0
+
+
+def _check_direct_io(info: int):
+    # the driver quietly falls back to indirect I/O whenever it is unable
+    # to map the buffer, which is worth knowing about when it happens.
+    if (info & SG_INFO_DIRECT_IO_MASK) != SG_INFO_DIRECT_IO:
+        warnings.warn("Direct I/O was not used for a command.", RuntimeWarning)
+
+
+def _allocate_reserved_buffer(device: int):
+    # without direct I/O, the driver copies everything through its own
+    # reserved buffer anyway, so bouncing through ours would only add to
+    # that, and pin memory which does nothing for us.
+    if device not in _direct_io_devices:
+        return
+
+    size_buffer = ct.c_int()
+    ioctl(device, SG_GET_RESERVED_SIZE, size_buffer)
+
+    if size_buffer.value > 0:
+        reserved_buffer = scsi_alloc_buffer(size_buffer.value)
+        _reserved_buffers[device] = (reserved_buffer, threading.Lock())
+
+    else:
+        _reserved_buffers.pop(device, None)
+
+
+def _execute_bounced(
+    device: int,
+    cdb: bytes,
+    buffer: Buffer,
+    reserved_buffer: memoryview,
+    timeout: int,
+    direction: int,
+) -> int:
+    data = memoryview(buffer).cast("B")
+    bounce = reserved_buffer[:len(data)]
+
+    if direction == SG_DXFER_TO_DEV:
+        bounce[:] = data
+
+    transferred = _execute_command(device, cdb, bounce, timeout, direction)
+
+    if direction == SG_DXFER_FROM_DEV:
+        data[:transferred] = bounce[:transferred]
+
+    return transferred
 
 
 def _execute_command(
     device: int,
     cdb: bytes,
-    buffer: bytes,
+    buffer: Buffer,
     timeout: int,
     direction: int,
-):
-    sense_buffer = bytes(MAX_SENSE_SIZE)
+) -> int:
+    # the number of bytes that were actually transferred is returned,
+    # since the device is free to send back less than was asked for.
+    writable = direction == SG_DXFER_FROM_DEV
+    address, length, mapping = buffer_address(buffer, writable)
+
+    # a buffer that isn't aligned to a page can't be transferred to by
+    # the device directly. if it fits, we can copy it through a pinned
+    # buffer that is instead, as long as no other thread is using it.
+    # only devices opened with `direct_io` have one of these at all.
+    reserve = _reserved_buffers.get(device)
+
+    if reserve is not None and address % PAGE_SIZE:
+        reserved_buffer, reserved_lock = reserve
+
+        if length <= len(reserved_buffer) and reserved_lock.acquire(False):
+            try:
+                return _execute_bounced(
+                    device,
+                    cdb,
+                    buffer,
+                    reserved_buffer,
+                    timeout,
+                    direction,
+                )
+
+            finally:
+                reserved_lock.release()
+
+    flags = _direct_io_flags(device, address)
+
+    if _execute_sync is not None:
+        result = _execute_sync(
+            device,
+            cdb,
+            address,
+            length,
+            direction,
+            timeout,
+            flags,
+        )
+
+        del mapping
+
+        # the residual count is all that comes back from a command that
+        # succeeded, with anything else being the details of a failure.
+        if isinstance(result, tuple):
+            _raise_for_status(*result)
 
-    sgio_hdr = SGIOHeader(
-        interface_id=SG_INTERFACE_ID_ORIG,
+        return _transferred(length, result)
 
-        cmdp=cdb,
-        cmd_len=len(cdb),
+    cdb_address, cdb_length, cdb_mapping = buffer_address(cdb, False)
 
-        dxfer_direction=direction,
-        dxferp=buffer,
-        dxfer_len=len(buffer),
+    request = _request_pool.get()
 
-        sbp=sense_buffer,
-        mx_sb_len=MAX_SENSE_SIZE,
-        timeout=timeout,
+    _pack_header(
+        request,
+        cdb_address,
+        cdb_length,
+        direction,
+        address,
+        length,
+        timeout,
+        flags,
     )
 
-    ioctl(device, SG_IO, sgio_hdr)
+    try:
+        # only the header itself is handed to the ioctl. it gets copied
+        # back into the request afterwards, which would otherwise write
+        # over the sense data that the kernel put in the buffer after it.
+        ioctl(device, SG_IO, request.header)
+
+        # the kernel is done with the buffers now, so it's safe to let go
+        # of the mappings that were keeping them exported during the ioctl.
+        del mapping, cdb_mapping
+
+        header_fields = _SGIO_HEADER.unpack_from(request)
+        _check_for_errors(header_fields, request)
+
+        if flags:
+            _check_direct_io(header_fields[_INFO_INDEX])
 
-    _check_for_errors(sgio_hdr, sense_buffer)
+        return _transferred(length, header_fields[_RESID_INDEX])
 
+    finally:
+        _request_pool.put(request)
 
-def scsi_open(device_path: os.PathLike) -> int:
-    device = os.open(device_path, os.O_RDWR | os.O_NONBLOCK)
+
+def _check_direct_io_allowed():
+    try:
+        with open(SG_ALLOW_DIO_PATH) as allow_dio_file:
+            allow_dio = allow_dio_file.read().strip()
+
+    except OSError:
+        allow_dio = "0"
+
+    # the driver would accept the flag anyway and just ignore it, so we
+    # refuse up front rather than letting every command fall back.
+    if allow_dio != "1":
+        raise SCSIError(f"Direct I/O is not allowed by {SG_ALLOW_DIO_PATH}")
+
+
+def scsi_open(device_path: os.PathLike, direct_io: bool = False) -> int:
+    if direct_io:
+        _check_direct_io_allowed()
+
+    # SG_IO always blocks until the command is done, so O_NONBLOCK is
+    # of no use to us. it only affects the `read()` in batched commands,
+    # which we `poll()` for anyway.
+    device = os.open(device_path, os.O_RDWR | os.O_CLOEXEC)
 
     # we don't know if the new file handle actually refers to a SCSI
     # Generic device yet. however, by querying the SG driver version
     # we can check that the SG driver is not too outdated, while also
-    # ensuring that we have indeed opened an actual SG device.
-    ver_major, ver_minor, ver_micro = _check_sg_version(device)
+    # ensuring that we have indeed opened an actual SG device. this is
+    # only done the first time a given device is opened.
+    stat = os.fstat(device)
+    device_id = (stat.st_dev, stat.st_rdev)
+
+    version = _sg_version_cache.get(device_id)
+
+    if version is None:
+        version = _check_sg_version(device)
+        _sg_version_cache[device_id] = version
+
+    ver_major, ver_minor, ver_micro = version
 
     if ver_major < 3:
         # earlier driver versions do not have the SG_IO ioctl we use.
@@ -189,13 +554,37 @@ def scsi_open(device_path: os.PathLike) -> int:
             f"Outdated SG driver: {ver_major}.{ver_minor}.{ver_micro}"
         )
 
+    if direct_io:
+        _direct_io_devices.add(device)
+        _allocate_reserved_buffer(device)
+
+    _queued_reads[device] = {}
+    _pack_ids[device] = itertools.count()
+    _batch_locks[device] = threading.Lock()
+
     return device
 
 
 def scsi_read(device: int, cdb: bytes, amount: int, timeout: int) -> bytes:
-    buffer = bytes(amount)
+    return read_response(
+        _execute_command,
+        _buffer_pool,
+        device,
+        cdb,
+        amount,
+        timeout,
+        SG_DXFER_FROM_DEV,
+        aligned=device in _direct_io_devices,
+    )
 
-    _execute_command(
+
+def scsi_read_into(
+    device: int,
+    cdb: bytes,
+    buffer: Buffer,
+    timeout: int,
+) -> int:
+    return _execute_command(
         device,
         cdb,
         buffer,
@@ -203,10 +592,199 @@ def scsi_read(device: int, cdb: bytes, amount: int, timeout: int) -> bytes:
         SG_DXFER_FROM_DEV
     )
 
-    return buffer
+
+def _submit_read(
+    device: int,
+    pack_id: int,
+    cdb: bytes,
+    amount: int,
+    timeout: int,
+):
+    queued = _queued_reads[device]
+    buffer = _buffer_pool.acquire(amount)
+    request = _request_pool.get()
+
+    # the read is recorded before it is queued up, so that there's never
+    # a moment where the kernel could write into a buffer we don't own.
+    queued[pack_id] = (buffer, request)
+
+    try:
+        # pooled buffers are mapped, so their memory is never moved and
+        # there is no need to keep the buffer exported while it's in use.
+        address, _, _ = buffer_address(buffer, writable=True)
+        cdb_address, cdb_length, cdb_mapping = buffer_address(cdb, False)
+
+        _pack_header(
+            request,
+            cdb_address,
+            cdb_length,
+            SG_DXFER_FROM_DEV,
+            address,
+            amount,
+            timeout,
+            _direct_io_flags(device, address),
+            pack_id,
+        )
+
+        # writing the header queues the command up without waiting for
+        # it. the header and CDB are copied at this point, but the buffers
+        # they point to are used until the response is read back.
+        os.write(device, request.header)
+        del cdb_mapping
+
+    except BaseException:
+        del queued[pack_id]
+        _request_pool.put(request)
+        _buffer_pool.release(buffer)
+        raise
+
+
+def _reap_read(
+    device: int,
+    poller: select.poll,
+) -> Tuple[int, Tuple[int, ...]]:
+    poller.poll()
+
+    # the reply is unpacked straight from the bytes that were read,
+    # rather than being copied into a new SGIOHeader to read it from.
+    response = os.read(device, _SGIO_HEADER.size)
+
+    if len(response) != _SGIO_HEADER.size:
+        raise SCSIError(f"Unexpected reply size: {len(response)} bytes")
+
+    header_fields = _SGIO_HEADER.unpack(response)
+
+    return header_fields[_PACK_ID_INDEX], header_fields
+
+
+def _release_read(device: int, pack_id: int):
+    # a reply that we have no record of can't be pointing at any of our
+    # buffers, so there is nothing to release for it.
+    buffer, request = _queued_reads[device].pop(pack_id, (None, None))
+
+    if buffer is not None:
+        _request_pool.put(request)
+        _buffer_pool.release(buffer)
+
+
+def scsi_read_batch(
+    device: int,
+    commands: Sequence[Tuple[bytes, int]],
+    timeout: int,
+) -> List[bytes]:
+    with _batch_locks[device]:
+        return _read_batch(device, commands, timeout)
+
+
+def _read_batch(
+    device: int,
+    commands: Sequence[Tuple[bytes, int]],
+    timeout: int,
+) -> List[bytes]:
+    results: List[Optional[bytes]] = [None] * len(commands)
+    error: Optional[Exception] = None
+
+    pack_ids = _pack_ids[device]
+    queued = _queued_reads[device]
+
+    # maps the pack_id of each read in this batch that is still queued
+    # up to the index of the command it was sent for.
+    in_progress: Dict[int, int] = {}
+
+    poller = select.poll()
+    poller.register(device, select.POLLIN)
+
+    submitted = 0
+
+    try:
+        while True:
+            # keep the driver's queue as full as we can, so the device
+            # always has the next command waiting once it's done with one.
+            # reads left behind by an earlier batch still take up room in
+            # the driver's queue until we've come across their replies.
+            while (
+                error is None
+                and submitted < len(commands)
+                and len(queued) < SG_MAX_QUEUE
+            ):
+                cdb, amount = commands[submitted]
+                pack_id = next(pack_ids) & PACK_ID_MASK
+
+                try:
+                    _submit_read(device, pack_id, cdb, amount, timeout)
+                    in_progress[pack_id] = submitted
+
+                except Exception as exc:
+                    error = exc
+
+                submitted += 1
+
+            finished = error is not None or submitted == len(commands)
+
+            if finished and not in_progress:
+                break
+
+            pack_id, header_fields = _reap_read(device, poller)
+            index = in_progress.pop(pack_id, None)
+
+            # replies that aren't from this batch were left behind by one
+            # that was cut short, so all they need is to be released.
+            if index is None:
+                _release_read(device, pack_id)
+                continue
+
+            # every command that has been queued must still be read back,
+            # even after a failure, otherwise their responses would be
+            # left behind for whatever gets read from this device next.
+            try:
+                buffer, request = queued[pack_id]
+                _check_for_errors(header_fields, request)
+
+                if device in _direct_io_devices:
+                    _check_direct_io(header_fields[_INFO_INDEX])
+
+                # anything past what the device sent back would still be
+                # left over from whatever was read into the buffer before.
+                amount = header_fields[_DXFER_LEN_INDEX]
+                transferred = _transferred(
+                    amount,
+                    header_fields[_RESID_INDEX],
+                )
+
+                results[index] = zero_filled(buffer[:amount], transferred)
+
+            except SCSIError as exc:
+                if error is None:
+                    error = exc
+
+            finally:
+                _release_read(device, pack_id)
+
+    finally:
+        # if anything else went wrong, the rest of the batch still has to
+        # be read back. should that fail too, the reads stay queued up and
+        # are released by whichever batch comes across their replies.
+        while in_progress:
+            pack_id, _ = _reap_read(device, poller)
+            in_progress.pop(pack_id, None)
+            _release_read(device, pack_id)
+
+    if error is not None:
+        raise error
+
+    return results
 
 
 def scsi_write(device: int, cdb: bytes, buffer: bytes, timeout: int) -> None:
+    scsi_write_from(device, cdb, buffer, timeout)
+
+
+def scsi_write_from(
+    device: int,
+    cdb: bytes,
+    buffer: Buffer,
+    timeout: int,
+) -> None:
     _execute_command(
         device,
         cdb,
@@ -216,5 +794,40 @@ def scsi_write(device: int, cdb: bytes, buffer: bytes, timeout: int) -> None:
     )
 
 
+def scsi_alloc_buffer(size: int, align: int = PAGE_SIZE) -> memoryview:
+    # populating the pages up front means that the first command to use
+    # this buffer won't have to fault every one of them in by itself.
+    buffer, address = map_aligned(
+        size,
+        align,
+        flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | MAP_POPULATE,
+    )
+
+    # locking the buffer in memory is only an optimisation, so we don't
+    # want to fail if we've run into RLIMIT_MEMLOCK or something else.
+    if _libc.mlock(address, size) != 0:
+        reason = os.strerror(ct.get_errno())
+        warnings.warn(f"Could not lock buffer: {reason}", RuntimeWarning)
+
+    return buffer
+
+
+def scsi_set_reserved_size(device: int, size: int) -> None:
+    ioctl(device, SG_SET_RESERVED_SIZE, ct.c_int(size))
+
+    # the driver is free to reserve a different amount to what we asked
+    # for, so our own buffer is sized by asking it what it settled on.
+    _allocate_reserved_buffer(device)
+
+
 def scsi_close(device: int) -> None:
+    _reserved_buffers.pop(device, None)
+    _direct_io_devices.discard(device)
+
+    # closing the device abandons any reads still queued up on it, so
+    # the kernel won't write into their buffers after this point.
     os.close(device)
+
+    _queued_reads.pop(device, None)
+    _pack_ids.pop(device, None)
+    _batch_locks.pop(device, None)
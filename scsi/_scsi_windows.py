@@ -1,11 +1,41 @@
 import os
 import ctypes as ct
 import ctypes.wintypes as wt
-from typing import Optional
-
-from scsi.utils import MAX_SENSE_SIZE, TypedStructure
-
-__all__ = ["scsi_open", "scsi_read", "scsi_write", "scsi_close"]
+import warnings
+import weakref
+from collections import deque
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from scsi.utils import (
+    MAX_SENSE_SIZE,
+    PAGE_SIZE,
+    Buffer,
+    BufferPool,
+    SCSIError,
+    SCSIStatus,
+    StructurePool,
+    TypedStructure,
+    buffer_address,
+    map_aligned,
+    read_response,
+    zero_filled,
+)
+
+__all__ = [
+    "scsi_open",
+    "scsi_read",
+    "scsi_read_into",
+    "scsi_read_batch",
+    "scsi_write",
+    "scsi_write_from",
+    "scsi_alloc_buffer",
+    "scsi_submit",
+    "scsi_reap",
+    "ReapedCommand",
+    "scsi_close",
+    "SCSI_IOCTL_DATA_OUT",
+    "SCSI_IOCTL_DATA_IN",
+]
 
 # this type is currently not defined, but i have asked about it on the
 # `capi-sig` mailing list to see if that might have been accidental.
@@ -18,6 +48,8 @@ SCSI_IOCTL_DATA_OUT = 0
 SCSI_IOCTL_DATA_IN = 1
 SCSI_IOCTL_DATA_UNSPECIFIED = 2
 
+_buffer_pool = BufferPool()
+
 
 class SCSIPassThroughDirect(TypedStructure):
     length: wt.USHORT
@@ -30,18 +62,54 @@ class SCSIPassThroughDirect(TypedStructure):
     data_in: UCHAR
     data_transfer_length: wt.ULONG
     timeout_value: wt.ULONG
-    data_buffer: ct.c_char_p
+    data_buffer: ct.c_void_p
     sense_info_offset: wt.ULONG
     cdb: ct.c_char * 16
 
-    # this sense buffer is not defined here in the reference struct.
-    # however, it is nice to have it here because it makes it easy to
-    # compute the value of `sense_info_offset`.
+
+# this isn't a windows struct, although it is modelled after the sample
+# SCSI_PASS_THROUGH_DIRECT_WITH_BUFFER. it puts the sense buffer just
+# after the header, which makes it easy to compute `sense_info_offset`,
+# while still letting `length` be the size of the header by itself.
+class SCSIPassThroughDirectWithSense(TypedStructure):
+    sptd: SCSIPassThroughDirect
+
     # TODO: implement a way of making this array variable-sized. this
     # would allow for a custom value for maximum sense size if needed.
-    sense_buffer: ct.c_char * MAX_SENSE_SIZE
+    sense_buffer: ct.c_ubyte * MAX_SENSE_SIZE
+
+
+class Overlapped(TypedStructure):
+    internal: ct.c_size_t
+    internal_high: ct.c_size_t
+    offset: wt.DWORD
+    offset_high: wt.DWORD
+    event: wt.HANDLE
+
+
+# this one isn't a windows struct, it just keeps everything that has to
+# stay alive for as long as a command is in progress in one place.
+class Command(TypedStructure):
+    overlapped: Overlapped
+    request: SCSIPassThroughDirectWithSense
+    event: wt.HANDLE
 
 
+# the size of SCSI_PASS_THROUGH_DIRECT in `ntddscsi.h`, which is laid
+# out naturally rather than packed. the driver rejects any other size,
+# so we would rather find out about a mismatch as early as possible.
+EXPECTED_HEADER_SIZE = 56 if ct.sizeof(ct.c_void_p) == 8 else 44
+
+HEADER_SIZE = ct.sizeof(SCSIPassThroughDirect)
+SENSE_OFFSET = SCSIPassThroughDirectWithSense._field_offsets_["sense_buffer"]
+
+if HEADER_SIZE != EXPECTED_HEADER_SIZE:
+    raise NotImplementedError(
+        f"Unexpected SCSI_PASS_THROUGH_DIRECT size: {HEADER_SIZE} bytes"
+    )
+
+COMMAND_POOL_SIZE = 16
+
 # the following code defines the constants required for CreateFileW:
 GENERIC_READ = 0x80000000  # for dwDesiredAccess
 GENERIC_WRITE = 0x40000000
@@ -52,8 +120,19 @@ FILE_SHARE_WRITE = 0x00000002
 OPEN_EXISTING = 3  # for dwCreationDisposition
 
 FILE_ATTRIBUTE_NORMAL = 0x80  # for dwFlagsAndAttributes
+FILE_FLAG_OVERLAPPED = 0x40000000
 
-_w32_create_file_w = ct.windll.kernel32.CreateFileW
+ERROR_IO_PENDING = 997
+INFINITE = 0xffffffff
+
+INVALID_HANDLE_VALUE = wt.HANDLE(-1).value
+
+# with `use_last_error`, ctypes saves the last error code as soon as
+# each of these functions returns, so it can't be overwritten by any
+# other call (including from another thread) before we get to read it.
+_kernel32 = ct.WinDLL("kernel32", use_last_error=True)
+
+_w32_create_file_w = _kernel32.CreateFileW
 _w32_create_file_w.restype = wt.HANDLE
 _w32_create_file_w.argtypes = [
     wt.LPCWSTR,  # lpFileName
@@ -65,11 +144,11 @@ _w32_create_file_w.argtypes = [
     wt.HANDLE,   # hTemplateFile
 ]
 
-_w32_close_handle = ct.windll.kernel32.CloseHandle
+_w32_close_handle = _kernel32.CloseHandle
 _w32_close_handle.restype = wt.BOOL
 _w32_close_handle.argtypes = [wt.HANDLE]
 
-_w32_device_io_control = ct.windll.kernel32.DeviceIoControl
+_w32_device_io_control = _kernel32.DeviceIoControl
 _w32_device_io_control.restype = wt.BOOL
 _w32_device_io_control.argtypes = [
     wt.HANDLE,   # hDevice
@@ -82,102 +161,314 @@ _w32_device_io_control.argtypes = [
     wt.LPVOID,   # lpOverlapped
 ]
 
+_w32_create_event_w = _kernel32.CreateEventW
+_w32_create_event_w.restype = wt.HANDLE
+_w32_create_event_w.argtypes = [
+    wt.LPVOID,   # lpEventAttributes
+    wt.BOOL,     # bManualReset
+    wt.BOOL,     # bInitialState
+    wt.LPCWSTR,  # lpName
+]
+
+_w32_get_overlapped_result = _kernel32.GetOverlappedResult
+_w32_get_overlapped_result.restype = wt.BOOL
+_w32_get_overlapped_result.argtypes = [
+    wt.HANDLE,   # hFile
+    wt.LPVOID,   # lpOverlapped
+    wt.LPDWORD,  # lpNumberOfBytesTransferred
+    wt.BOOL,     # bWait
+]
+
+_w32_create_io_completion_port = _kernel32.CreateIoCompletionPort
+_w32_create_io_completion_port.restype = wt.HANDLE
+_w32_create_io_completion_port.argtypes = [
+    wt.HANDLE,   # FileHandle
+    wt.HANDLE,   # ExistingCompletionPort
+    ct.c_size_t,  # CompletionKey
+    wt.DWORD,    # NumberOfConcurrentThreads
+]
+
+_w32_get_queued_completion_status = _kernel32.GetQueuedCompletionStatus
+_w32_get_queued_completion_status.restype = wt.BOOL
+_w32_get_queued_completion_status.argtypes = [
+    wt.HANDLE,                  # CompletionPort
+    wt.LPDWORD,                 # lpNumberOfBytesTransferred
+    ct.POINTER(ct.c_size_t),    # lpCompletionKey
+    ct.POINTER(ct.c_void_p),    # lpOverlapped
+    wt.DWORD,                   # dwMilliseconds
+]
+
+_w32_virtual_lock = _kernel32.VirtualLock
+_w32_virtual_lock.restype = wt.BOOL
+_w32_virtual_lock.argtypes = [
+    wt.LPVOID,   # lpAddress
+    ct.c_size_t,  # dwSize
+]
+
+class ReapedCommand(NamedTuple):
+    token: int
+    transferred: int
+    error: Optional[Exception]
+
+
+# each open device gets its own completion port, and a record of the
+# commands submitted through `scsi_submit` which haven't been reaped.
+_completion_ports: Dict[int, int] = {}
+_pending_commands: Dict[int, Dict[int, Tuple[Command, Any]]] = {}
+
+
+def _new_command() -> Command:
+    command = Command()
+
+    # these fields are the same for every command we send, so they can
+    # be filled in once here rather than every time a header is reused.
+    command.request.sptd.length = HEADER_SIZE
+    command.request.sptd.sense_info_offset = SENSE_OFFSET
+
+    command.event = _w32_create_event_w(None, True, False, None)
+    if not command.event:
+        _raise_last_error()
+
+    # the pool lets go of commands once it has enough of them, and each
+    # thread's pool is dropped when it exits, so the event is closed off
+    # whenever its command is collected rather than by whoever used it.
+    weakref.finalize(command, _w32_close_handle, command.event)
+
+    return command
+
+
+_command_pool = StructurePool(_new_command, COMMAND_POOL_SIZE)
+
 
 def _device_io_control(
     handle: int,
     control_code: int,
-    in_buffer: Optional[ct.Array],
-    out_buffer: Optional[ct.Array],
+    in_buffer: Any,
+    in_size: int,
+    out_buffer: Any,
+    out_size: int,
+    overlapped: Overlapped,
 ):
-    if in_buffer is None:
-        in_buffer = ct.create_string_buffer(0)
-
-    if out_buffer is None:
-        out_buffer = ct.create_string_buffer(0)
-
-    bytes_returned = wt.DWORD()
-
-    _w32_device_io_control(
+    result = _w32_device_io_control(
         handle,
         control_code,
         in_buffer,
-        len(in_buffer),
+        in_size,
         out_buffer,
-        len(out_buffer),
-        ct.byref(bytes_returned),
-        None
+        out_size,
+        None,
+        ct.byref(overlapped),
     )
 
-    _raise_last_error()
+    # the device was opened for overlapped I/O, so a command that has
+    # been queued up but not yet finished is reported as a failure.
+    if not result:
+        last_error = ct.get_last_error()
 
+        if last_error != ERROR_IO_PENDING:
+            raise ct.WinError(last_error)
 
-def _execute_command(
-    handle: int,
+
+def _prepare_command(
+    command: Command,
     cdb: bytes,
-    buffer: bytes,
+    buffer: Buffer,
     timeout: int,
     direction: int,
-):
+    wait: bool,
+) -> Any:
+    writable = direction == SCSI_IOCTL_DATA_IN
+    address, length, mapping = buffer_address(buffer, writable)
 
-    # account for the extra sense buffer we have on the end
-    header_size = ct.sizeof(SCSIPassThroughDirect) - MAX_SENSE_SIZE
-    sense_buffer = bytes(MAX_SENSE_SIZE)
-
-    scsi_header = SCSIPassThroughDirect(
-        length=header_size,
-        cdb_length=len(cdb),
-        sense_info_length=MAX_SENSE_SIZE,
-        data_in=direction,
-        data_transfer_length=len(buffer),
-        timeout_value=timeout,
-        data_buffer=buffer,
-        sense_info_offset=header_size,
-        cdb=cdb,
-        sense_buffer=sense_buffer
-    )
+    request = command.request
+    scsi_header = request.sptd
 
-    scsi_header_buffer = ct.string_at(
-        ct.addressof(scsi_header),
-        ct.sizeof(scsi_header),
-    )
+    scsi_header.cdb_length = len(cdb)
+    scsi_header.data_in = direction
+    scsi_header.data_transfer_length = length
+    scsi_header.timeout_value = timeout
+    scsi_header.data_buffer = address
+    scsi_header.cdb = cdb
+
+    # the driver shrinks `sense_info_length` down to however much sense
+    # data it returned, so it is reset along with the buffer each time.
+    scsi_header.sense_info_length = MAX_SENSE_SIZE
+    ct.memset(ct.addressof(request) + SENSE_OFFSET, 0, MAX_SENSE_SIZE)
+
+    overlapped = command.overlapped
+    overlapped.internal = 0
+    overlapped.internal_high = 0
+
+    # setting the lowest bit of the event handle stops the completion
+    # from being posted to the port, so that we can wait for the event
+    # ourselves without taking the completion away from `scsi_reap`.
+    overlapped.event = (command.event | 1) if wait else None
+
+    # the returned mapping keeps the buffer exported, so the caller must
+    # hold on to it until the device is done with the command.
+    return mapping
+
+
+def _issue_command(handle: int, command: Command):
+    request = command.request
 
+    # the request is used as the output buffer too, since that is where
+    # the device reports back its status and sense data.
     _device_io_control(
         handle,
         IOCTL_SCSI_PASS_THROUGH_DIRECT,
-        scsi_header_buffer,
-        None,
+        ct.byref(request),
+        ct.sizeof(request),
+        ct.byref(request),
+        ct.sizeof(request),
+        command.overlapped,
+    )
+
+
+def _start_command(
+    handle: int,
+    command: Command,
+    cdb: bytes,
+    buffer: Buffer,
+    timeout: int,
+    direction: int,
+    wait: bool,
+) -> Any:
+    mapping = _prepare_command(
+        command,
+        cdb,
+        buffer,
+        timeout,
+        direction,
+        wait,
+    )
+
+    _issue_command(handle, command)
+
+    return mapping
+
+
+def _check_for_errors(request: SCSIPassThroughDirectWithSense):
+    scsi_header = request.sptd
+    status = scsi_header.scsi_status
+
+    if status == SCSIStatus.GOOD:
+        return
+
+    # `sense_info_length` has been shrunk by the driver to the amount of
+    # sense data it actually returned, the same as `sb_len_wr` on linux.
+    sense = bytes(request.sense_buffer)[:scsi_header.sense_info_length]
+    sense_info = f"sense buffer: {sense.hex()}"
+
+    SCSIStatus(status).raise_if_bad(sense_info, sense)
+
+
+def _wait_for_command(handle: int, command: Command):
+    bytes_transferred = wt.DWORD()
+
+    result = _w32_get_overlapped_result(
+        handle,
+        ct.byref(command.overlapped),
+        ct.byref(bytes_transferred),
+        True,
     )
 
-    # TODO: deal with the `scsi_status` and `sense_buffer` attributes.
-    # these should be used to raise SCSI-specific errors that appear.
+    if not result:
+        _raise_last_error()
+
+    _check_for_errors(command.request)
+
+
+def _execute_command(
+    handle: int,
+    cdb: bytes,
+    buffer: Buffer,
+    timeout: int,
+    direction: int,
+) -> int:
+    command = _command_pool.get()
+
+    try:
+        mapping = _start_command(
+            handle,
+            command,
+            cdb,
+            buffer,
+            timeout,
+            direction,
+            wait=True,
+        )
+
+        _wait_for_command(handle, command)
+
+        # the device is done with the buffer now, so it's safe to let go
+        # of the mapping that was keeping it exported during the call.
+        del mapping
+
+        # the driver sets this to the amount that was actually transferred,
+        # since the device is free to send back less than was asked for.
+        return command.request.sptd.data_transfer_length
+
+    finally:
+        _command_pool.put(command)
 
 
 def _raise_last_error():
-    last_error = ct.GetLastError()
-    if last_error != 0:
-        raise ct.WinError(last_error)
+    # this should only be called once a function has reported a failure,
+    # since the last error code is left untouched by successful calls.
+    raise ct.WinError(ct.get_last_error())
 
 
-def scsi_open(device_path: os.PathLike) -> int:
+def scsi_open(device_path: os.PathLike, direct_io: bool = False) -> int:
+    # IOCTL_SCSI_PASS_THROUGH_DIRECT already transfers straight to and
+    # from the caller's buffer, so `direct_io` is only accepted here to
+    # keep the signature the same as on linux.
     device = _w32_create_file_w(
         device_path,
         GENERIC_READ | GENERIC_WRITE,
         FILE_SHARE_READ | FILE_SHARE_WRITE,
         None,
         OPEN_EXISTING,
-        FILE_ATTRIBUTE_NORMAL,
+        FILE_ATTRIBUTE_NORMAL | FILE_FLAG_OVERLAPPED,
         None,
     )
 
-    _raise_last_error()
+    if device == INVALID_HANDLE_VALUE:
+        _raise_last_error()
+
+    port = _w32_create_io_completion_port(device, None, 0, 0)
+
+    if not port:
+        # closing the device here would overwrite the last error code.
+        error = ct.WinError(ct.get_last_error())
+        _w32_close_handle(device)
+        raise error
+
+    _completion_ports[device] = port
+    _pending_commands[device] = {}
 
     return device
 
 
 def scsi_read(device: int, cdb: bytes, amount: int, timeout: int) -> bytes:
-    buffer = bytes(amount)
+    return read_response(
+        _execute_command,
+        _buffer_pool,
+        device,
+        cdb,
+        amount,
+        timeout // 1000,
+        SCSI_IOCTL_DATA_IN,
+    )
 
-    _execute_command(
+
+def scsi_read_into(
+    device: int,
+    cdb: bytes,
+    buffer: Buffer,
+    timeout: int,
+) -> int:
+    return _execute_command(
         device,
         cdb,
         buffer,
@@ -185,10 +476,101 @@ def scsi_read(device: int, cdb: bytes, amount: int, timeout: int) -> bytes:
         SCSI_IOCTL_DATA_IN,
     )
 
-    return buffer
+
+def _finish_read(
+    device: int,
+    command: Command,
+    buffer: memoryview,
+    amount: int,
+    mapping: Any,
+) -> bytes:
+    try:
+        _wait_for_command(device, command)
+        del mapping
+
+        # anything past what the device sent back would still be left
+        # over from whatever was read into the buffer before.
+        transferred = command.request.sptd.data_transfer_length
+        return zero_filled(buffer[:amount], transferred)
+
+    finally:
+        _command_pool.put(command)
+        _buffer_pool.release(buffer)
+
+
+def scsi_read_batch(
+    device: int,
+    commands: Sequence[Tuple[bytes, int]],
+    timeout: int,
+) -> List[bytes]:
+    results: List[bytes] = []
+    in_progress: deque = deque()
+    error = None
+
+    # commands are queued up in a window, so the device always has the
+    # next command waiting once it has finished with the one before it.
+    # the responses are still collected in order as they come in.
+    try:
+        for cdb, amount in commands:
+            if len(in_progress) == COMMAND_POOL_SIZE:
+                try:
+                    results.append(
+                        _finish_read(device, *in_progress.popleft())
+                    )
+
+                except (OSError, SCSIError) as exc:
+                    error = exc
+                    break
+
+            command = _command_pool.get()
+            buffer = _buffer_pool.acquire(amount)
+
+            try:
+                mapping = _start_command(
+                    device,
+                    command,
+                    cdb,
+                    buffer[:amount],
+                    timeout // 1000,
+                    SCSI_IOCTL_DATA_IN,
+                    wait=True,
+                )
+
+            except Exception as exc:
+                _command_pool.put(command)
+                _buffer_pool.release(buffer)
+                error = exc
+                break
+
+            in_progress.append((command, buffer, amount, mapping))
+
+    finally:
+        # every command that was started must be waited for, even after
+        # a failure, since the device may still be writing into its buffer.
+        while in_progress:
+            try:
+                results.append(_finish_read(device, *in_progress.popleft()))
+
+            except (OSError, SCSIError) as exc:
+                if error is None:
+                    error = exc
+
+    if error is not None:
+        raise error
+
+    return results
 
 
 def scsi_write(device: int, cdb: bytes, buffer: bytes, timeout: int) -> None:
+    scsi_write_from(device, cdb, buffer, timeout)
+
+
+def scsi_write_from(
+    device: int,
+    cdb: bytes,
+    buffer: Buffer,
+    timeout: int,
+) -> None:
     _execute_command(
         device,
         cdb,
@@ -198,6 +580,129 @@ def scsi_write(device: int, cdb: bytes, buffer: bytes, timeout: int) -> None:
     )
 
 
+def scsi_submit(
+    device: int,
+    cdb: bytes,
+    buffer: Buffer,
+    timeout: int,
+    direction: int,
+) -> int:
+    command = _command_pool.get()
+    pending = _pending_commands[device]
+
+    # the overlapped struct is what the completion port hands back to
+    # us once the command is done, so its address identifies it.
+    token = ct.addressof(command.overlapped)
+
+    try:
+        mapping = _prepare_command(
+            command,
+            cdb,
+            buffer,
+            timeout // 1000,
+            direction,
+            wait=False,
+        )
+
+    except BaseException:
+        _command_pool.put(command)
+        raise
+
+    # the command has to be recorded before it is started, as another
+    # thread could otherwise reap it before we get the chance. once it
+    # has been started, it's up to `scsi_reap` to take it out of here.
+    pending[token] = (command, mapping)
+
+    try:
+        _issue_command(device, command)
+
+    # a command that failed to start never completes, which would leave
+    # `scsi_reap` (and so `scsi_close`) waiting forever for it to finish.
+    except BaseException:
+        del pending[token]
+        _command_pool.put(command)
+        raise
+
+    return token
+
+
+def scsi_reap(device: int, count: int) -> List[ReapedCommand]:
+    port = _completion_ports[device]
+    pending = _pending_commands[device]
+
+    # each command is reported on its own, since the caller has to know
+    # which buffers are free again even when some of the commands failed.
+    reaped = []
+
+    bytes_transferred = wt.DWORD()
+    completion_key = ct.c_size_t()
+    overlapped = ct.c_void_p()
+
+    for _ in range(count):
+        result = _w32_get_queued_completion_status(
+            port,
+            ct.byref(bytes_transferred),
+            ct.byref(completion_key),
+            ct.byref(overlapped),
+            INFINITE,
+        )
+
+        # without an overlapped struct, it is the wait itself that has
+        # failed rather than any one of the commands we submitted. the
+        # commands reaped so far are still handed back, and the next call
+        # will run into the same failure if it hasn't gone away by then.
+        if overlapped.value is None:
+            if reaped:
+                break
+
+            _raise_last_error()
+
+        token = overlapped.value
+        command, mapping = pending.pop(token)
+        error = None
+
+        try:
+            if not result:
+                _raise_last_error()
+
+            _check_for_errors(command.request)
+
+        except (OSError, SCSIError) as exc:
+            error = exc
+
+        finally:
+            transferred = command.request.sptd.data_transfer_length
+            _command_pool.put(command)
+
+        reaped.append(ReapedCommand(token, transferred, error))
+
+    return reaped
+
+
+def scsi_alloc_buffer(size: int, align: int = PAGE_SIZE) -> memoryview:
+    buffer, address = map_aligned(size, align)
+
+    # locking the buffer in memory is only an optimisation, so we don't
+    # want to fail if the working set is too small or something else.
+    if not _w32_virtual_lock(address, size):
+        reason = ct.FormatError(ct.get_last_error())
+        warnings.warn(f"Could not lock buffer: {reason}", RuntimeWarning)
+
+    return buffer
+
+
 def scsi_close(device: int) -> None:
-    _w32_close_handle(device)
-    _raise_last_error()
+    pending = _pending_commands[device]
+
+    try:
+        # the device could still be writing into the buffers of commands
+        # that have not been reaped, so they have to be waited for here.
+        if pending:
+            scsi_reap(device, len(pending))
+
+    finally:
+        del _pending_commands[device]
+        _w32_close_handle(_completion_ports.pop(device))
+
+        if not _w32_close_handle(device):
+            _raise_last_error()
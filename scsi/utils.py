@@ -1,9 +1,27 @@
 import ctypes as ct
+import mmap
+import threading
+from collections import deque
 from enum import IntEnum
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 MAX_SENSE_SIZE = 32
 
+PAGE_SIZE = 4096
+
+# reads larger than this are not worth keeping around between calls, so
+# they are given a buffer of their own instead of a pooled buffer.
+MAX_POOLED_SIZE = 1 << 20
+MAX_POOLED_PER_SIZE = 4
+
+# anything that supports the buffer protocol will do, but these are the
+# types that we expect people to be passing in most of the time.
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap, ct.Array]
+
+_bytes_from_string_and_size = ct.pythonapi.PyBytes_FromStringAndSize
+_bytes_from_string_and_size.restype = ct.py_object
+_bytes_from_string_and_size.argtypes = [ct.c_void_p, ct.c_ssize_t]
+
 # the type of `Structure` can be found in the `_ctypes` module, but we
 # cannot just import it because the `_ctypes` module does not export
 # that type. instead, we can just steal it from the class itself. :D
@@ -12,15 +30,257 @@ MetaStructure = type(ct.Structure)
 
 class MetaTypedStructure(MetaStructure):
     def __new__(metacls, name, bases, attrs, **kwargs):
-        type_hints = attrs.get("__annotations__", {})
-        attrs["_fields_"] = list(type_hints.items())
-        return super().__new__(metacls, name, bases, attrs, **kwargs)
+        type_hints = attrs.get("__annotations__")
+
+        # without any annotations of its own, the class can just inherit
+        # the fields of its base, so there is nothing more to be done.
+        if not type_hints:
+            return super().__new__(metacls, name, bases, attrs, **kwargs)
+
+        fields = tuple(type_hints.items())
+        attrs["_fields_"] = fields
+
+        cls = super().__new__(metacls, name, bases, attrs, **kwargs)
+
+        # keeping the offsets of each field around lets us read and write
+        # the raw bytes of a structure without going through ctypes.
+        offsets = dict(getattr(cls, "_field_offsets_", {}))
+
+        for field_name, _ in fields:
+            offsets[field_name] = getattr(cls, field_name).offset
+
+        cls._field_offsets_ = offsets
+
+        return cls
 
 
 class TypedStructure(ct.Structure, metaclass=MetaTypedStructure):
     pass
 
 
+class BufferPool(threading.local):
+    """
+    A per-thread free-list of transfer buffers, grouped by size.
+
+    Sizes are rounded up to the next power of two (and at least one
+    page) so that reads of similar sizes can share the same buffers.
+    Every buffer is mapped on a page boundary, so the kernel always
+    sees whole, page-aligned ranges.
+    """
+
+    def __init__(self):
+        self._buffers: Dict[int, List[memoryview]] = {}
+
+    @staticmethod
+    def _bucket_size(size: int) -> int:
+        if size > MAX_POOLED_SIZE:
+            # this buffer won't be pooled, so only round to whole pages.
+            return -(-size // PAGE_SIZE) * PAGE_SIZE
+
+        return max(PAGE_SIZE, 1 << (size - 1).bit_length())
+
+    def acquire(self, size: int) -> memoryview:
+        bucket_size = self._bucket_size(size)
+        bucket = self._buffers.get(bucket_size)
+
+        if bucket:
+            return bucket.pop()
+
+        buffer, _ = map_aligned(bucket_size, PAGE_SIZE)
+        return buffer
+
+    def release(self, buffer: memoryview):
+        bucket_size = len(buffer)
+        if bucket_size > MAX_POOLED_SIZE:
+            return
+
+        bucket = self._buffers.setdefault(bucket_size, [])
+        if len(bucket) < MAX_POOLED_PER_SIZE:
+            bucket.append(buffer)
+
+
+class StructurePool(threading.local):
+    """
+    A per-thread pool of reusable structures, such as command headers.
+
+    Building a structure from scratch means setting every one of its
+    fields through ctypes, so it is much cheaper to hold on to a few
+    and only update the fields that change between uses.
+    """
+
+    def __init__(self, factory: Callable[[], ct.Structure], size: int):
+        self._factory = factory
+        self._free: deque = deque(maxlen=size)
+
+    def get(self) -> ct.Structure:
+        if self._free:
+            return self._free.pop()
+
+        return self._factory()
+
+    def put(self, structure: ct.Structure):
+        self._free.append(structure)
+
+
+def buffer_address(buffer: Buffer, writable: bool) -> Tuple[int, int, Any]:
+    """
+    Find the address and size in bytes of a contiguous buffer.
+
+    The third item returned is the object that keeps the buffer's
+    memory exported (and so stops it from being resized or moved). It
+    must be kept alive for as long as the address is in use.
+
+    Read-only buffers other than `bytes` cannot be exported in place
+    through ctypes, so those will be copied as a last resort.
+    """
+    view = memoryview(buffer)
+
+    if not view.c_contiguous:
+        raise ValueError("Buffer must be C-contiguous.")
+
+    if writable and view.readonly:
+        raise ValueError("Buffer must be writable.")
+
+    if isinstance(buffer, bytes):
+        mapping = ct.c_char_p(buffer)
+        return ct.cast(mapping, ct.c_void_p).value, len(buffer), mapping
+
+    view = view.cast("B")
+    array_type = ct.c_char * len(view)
+
+    if view.readonly:
+        mapping = array_type.from_buffer_copy(view)
+    else:
+        mapping = array_type.from_buffer(view)
+
+    return ct.addressof(mapping), len(view), mapping
+
+
+def uninitialized_bytes(size: int) -> Tuple[bytes, ct.Array]:
+    """
+    Create a `bytes` object without zero-filling it first.
+
+    A writable array over the new object's contents is returned with
+    it, so that it can be filled in before it is handed out anywhere.
+    This is only safe because nothing else can have seen it yet.
+    """
+    data = _bytes_from_string_and_size(None, size)
+
+    address = ct.cast(ct.c_char_p(data), ct.c_void_p).value
+    array = (ct.c_char * size).from_address(address)
+
+    return data, array
+
+
+def map_aligned(size: int, align: int, **kwargs) -> Tuple[memoryview, int]:
+    """
+    Map some anonymous memory, aligned to a given power of two.
+
+    This returns a view of `size` bytes starting on an `align`-byte
+    boundary, alongside the address of that boundary. Any keyword
+    arguments are passed on to `mmap.mmap`.
+    """
+    if align <= 0 or align & (align - 1):
+        raise ValueError("Alignment must be a power of two.")
+
+    # anonymous mappings always start on a page boundary, so we only
+    # need to reserve extra space for an alignment coarser than that.
+    padding = max(0, align - mmap.PAGESIZE)
+    mapping = mmap.mmap(-1, size + padding, **kwargs)
+
+    # the array only exists to find the address, and has to be deleted
+    # straight away because it would stop the mapping from being closed.
+    array = ct.c_char.from_buffer(mapping)
+    address = ct.addressof(array)
+    del array
+
+    offset = -address % align
+
+    return memoryview(mapping)[offset:offset + size], address + offset
+
+
+def zero_filled(view: memoryview, transferred: int) -> bytes:
+    """
+    Copy a response out of a view, with anything past the amount that
+    was transferred replaced by zeroes, so that no earlier data leaks.
+    """
+    if transferred < len(view):
+        view[transferred:] = bytes(len(view) - transferred)
+
+    return view.tobytes()
+
+
+def read_response(
+    execute: Callable[[int, bytes, Buffer, int, int], int],
+    pool: BufferPool,
+    device: int,
+    cdb: bytes,
+    amount: int,
+    timeout: int,
+    direction: int,
+    aligned: bool = False,
+) -> bytes:
+    """
+    Send a command and return its response as a new `bytes` object.
+
+    This is how each platform implements `scsi_read`, with `execute`
+    sending the command in that platform's own way and returning how
+    many bytes were actually transferred. The response always has the
+    length that was asked for, with anything the device didn't send
+    filled in with zeroes, the same as each of the responses that
+    `scsi_read_batch` returns.
+
+    If `aligned` is set, the response is always read into memory that
+    starts on a page boundary, even when it's too big to be pooled.
+    """
+    if amount > MAX_POOLED_SIZE and aligned:
+        # the data of a `bytes` object is never page-aligned, so it is
+        # read into a mapping that is instead, and then copied out of it.
+        buffer, _ = map_aligned(amount, PAGE_SIZE)
+
+        with buffer as view:
+            transferred = execute(device, cdb, view, timeout, direction)
+            return zero_filled(view, transferred)
+
+    if amount > MAX_POOLED_SIZE:
+        # a buffer this big wouldn't be kept in the pool anyway, so it's
+        # better to read into the `bytes` object that we return, instead
+        # of copying into it afterwards. this skips zero-filling it, too,
+        # so whatever the device didn't send has to be zeroed afterwards.
+        response, response_array = uninitialized_bytes(amount)
+
+        transferred = execute(
+            device,
+            cdb,
+            response_array,
+            timeout,
+            direction,
+        )
+
+        if transferred < amount:
+            ct.memset(
+                ct.addressof(response_array) + transferred,
+                0,
+                amount - transferred,
+            )
+
+        return response
+
+    # reusing buffers between reads saves us from zero-filling a fresh
+    # allocation every time, and keeps the pages we read into resident.
+    buffer = pool.acquire(amount)
+
+    try:
+        with buffer[:amount] as view:
+            transferred = execute(device, cdb, view, timeout, direction)
+
+            # the rest of a pooled buffer still holds an earlier response.
+            return zero_filled(view, transferred)
+
+    finally:
+        pool.release(buffer)
+
+
 class SCSIStatus(IntEnum):
     GOOD = 0x00
     CHECK_CONDITION = 0x02
@@ -34,9 +294,42 @@ class SCSIStatus(IntEnum):
     ACA_ACTIVE = 0x30
     TASK_ABORTED = 0x40
 
-    def raise_if_bad(self, message: Optional[str] = None):
+    def raise_if_bad(
+        self,
+        message: Optional[str] = None,
+        sense: Optional[bytes] = None,
+    ):
         if self is not SCSIStatus.GOOD:
-            raise SCSIStatusError(self, message)
+            raise SCSIStatusError(self, message, sense)
+
+
+def parse_sense(
+    sense: bytes,
+) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+    """
+    Find the sense key, ASC and ASCQ in a buffer of sense data.
+
+    Both the fixed and descriptor formats are understood. Any of the
+    values that can't be found are returned as None instead.
+    """
+    if not sense:
+        return None, None, None
+
+    response_code = sense[0] & 0x7f
+
+    # fixed format, for current (0x70) or deferred (0x71) errors.
+    if response_code in (0x70, 0x71):
+        sense_key = sense[2] & 0x0f if len(sense) > 2 else None
+        asc = sense[12] if len(sense) > 12 else None
+        ascq = sense[13] if len(sense) > 13 else None
+
+        return sense_key, asc, ascq
+
+    # descriptor format, which keeps all three at the very start.
+    if response_code in (0x72, 0x73) and len(sense) > 3:
+        return sense[1] & 0x0f, sense[2], sense[3]
+
+    return None, None, None
 
 
 class SCSIError(Exception):
@@ -50,10 +343,26 @@ class SCSIError(Exception):
 
 
 class SCSIStatusError(SCSIError):
-    def __init__(self, status: SCSIStatus, message: Optional[str] = None):
+    """
+    An error for when a device reports a bad SCSI status.
+
+    If the device returned any sense data alongside the status, then
+    the sense key, ASC and ASCQ from it are kept on the error, which
+    is usually enough to decide whether a command is worth retrying.
+    """
+
+    def __init__(
+        self,
+        status: SCSIStatus,
+        message: Optional[str] = None,
+        sense: Optional[bytes] = None,
+    ):
         self.status = status
         self.message = message
 
+        self.sense = sense
+        self.sense_key, self.asc, self.ascq = parse_sense(sense or b"")
+
     def __str__(self):
         if self.message is None:
             return self.status.name